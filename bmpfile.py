@@ -1,8 +1,54 @@
+import logging
+import mmap
+import os
+import struct
+import numpy as np
+from jit import njit, prange, serialized, HAVE_NUMBA
+
+# BITMAPFILEHEADER + BITMAPINFOHEADER starting after the "BM" magic, up to biClrUsed:
+# bfSize, (reserved), bfOffBits, biSize, biWidth, biHeight, biPlanes, biBitCount,
+# biCompression, biSizeImage, biXPelsPerMeter, biYPelsPerMeter, biClrUsed
+BMP_HEADER = struct.Struct("<I4xIIiiHHIIiiI")
+
+logger = logging.getLogger(__name__)
+
+
+@serialized
+@njit(parallel=True, cache=True, boundscheck=False, nogil=True)
+def _unpack_rows(rows, width, bpp, palette):
+    # Unpack + palette lookup for every BI_RGB layout in one pass. Rows don't depend
+    # on each other, so they're split across threads
+    H = rows.shape[0]
+    out = np.empty((H, width, 3), dtype=np.uint8)
+    for y in prange(H):
+        row = rows[y]
+        for x in range(width):
+            if bpp == 24:
+                # B, G, R
+                out[y, x, 0] = row[3 * x + 2]
+                out[y, x, 1] = row[3 * x + 1]
+                out[y, x, 2] = row[3 * x]
+                continue
+            # int32 everywhere, otherwise numba unifies the branches to float
+            if bpp == 8:
+                idx = np.int32(row[x])
+            elif bpp == 4:
+                # high nibble first
+                byte = np.int32(row[x >> 1])
+                idx = byte >> 4 if (x & 1) == 0 else byte & 0x0F
+            else:
+                # MSB first
+                idx = (np.int32(row[x >> 3]) >> (7 - (x & 7))) & 1
+            out[y, x, 0] = palette[idx, 0]
+            out[y, x, 1] = palette[idx, 1]
+            out[y, x, 2] = palette[idx, 2]
+    return out
 
 class BMPFile:
     def __init__(self, url):
         self.url = url
         self.bytes = None
+        self._mm = None # read-only mapping backing self.bytes
         self.fileSize = 0
         self.filename = None
         self.height = 0
@@ -11,27 +57,53 @@ class BMPFile:
         self.compression = None
         self.bpp = None
         self.colorTable = [] # list[(R,G,B,A)]
+        self._palette_rgb = None # colorTable as an RGB lookup table
         self.numColors = 0
-        self.pixelmap = []
+        self.rowStride = 0 # bytes per stored row, padded to 4
+        self.absHeight = 0
+        self.topDown = False # negative height means rows are stored top row first
+        self.pixelmap = None
         if self.url is not None:
             self.openFile()
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __del__(self):
+        try:
+            self.close()
+        except BufferError:
+            pass # something still holds a view of the mapping, let GC unmap it
+
+    def close(self):
+        # Drop the file mapping. Parsed pixelmaps are copies so they stay valid
+        if self._mm is not None:
+            self.bytes.release()
+            self._mm.close()
+            self._mm = None
+            self.bytes = None
+
     def openFile(self):
+        # Map the file instead of reading it, the OS pages pixel data in on demand
+        # and np.frombuffer views it without another full copy
         with open(self.url, "rb") as f:
-            self.filename = self.url.split("/")[-1]
-            self.bytes = f.read()
-        self.fileSize = int.from_bytes(self.bytes[0x02:0x06], "little")
-        self.dataOffset = int.from_bytes(self.bytes[0x0A:0x0E], "little")  # bfOffBits
-        self.width = int.from_bytes(self.bytes[0x12:0x16], "little")
-        self.height = int.from_bytes(self.bytes[0x16:0x1A], "little")  # can be negative
-        self.bpp = int.from_bytes(self.bytes[0x1C:0x1E], "little")
-        self.compression = int.from_bytes(self.bytes[0x1E:0x22], "little")
+            self.filename = os.path.basename(self.url)
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.bytes = memoryview(self._mm)
+        (self.fileSize, self.dataOffset, _header_size, self.width, self.height,  # height can be negative
+         _planes, self.bpp, self.compression, _size_image, _xppm, _yppm,
+         self.numColors) = BMP_HEADER.unpack_from(self.bytes, 0x02)
 
         if self.compression != 0:
-            print("Can't handle compressed BMP (compression != BI_RGB)")
-            exit(1)
+            raise ValueError("Can't handle compressed BMP (compression != BI_RGB)")
+
+        self.rowStride = ((self.bpp * self.width + 31) // 32) * 4
+        self.absHeight = abs(self.height)
+        self.topDown = self.height < 0
 
-        self.numColors = int.from_bytes(self.bytes[0x2E:0x32], "little")
         if self.numColors == 0 and self.bpp <= 8:
             self.numColors = 256 if self.bpp == 8 else (1 << self.bpp)
 
@@ -45,20 +117,18 @@ class BMPFile:
             # Clamp to file bounds
             palette_end = min(colortable_offset + palette_bytes, len(self.bytes))
             entries = (palette_end - colortable_offset) // 4
-            for i in range(entries):
-                b = self.bytes[colortable_offset + i*4 + 0]
-                g = self.bytes[colortable_offset + i*4 + 1]
-                r = self.bytes[colortable_offset + i*4 + 2]
-                a = self.bytes[colortable_offset + i*4 + 3]  # usually 0
-                self.colorTable.append((r, g, b, a))
-
-        print("File size:", self.fileSize)
-        print("Width:", self.width)
-        print("Height:", self.height)
-        print("Bits per pixel:", self.bpp)
-        print("Compression:", self.compression)
-        print("Data offset:", self.dataOffset)
-        print("Palette entries:", len(self.colorTable))
+            # B, G, R, A per entry (A usually 0)
+            palette = np.frombuffer(self.bytes, dtype=np.uint8, count=entries * 4, offset=colortable_offset)
+            palette = palette.reshape(-1, 4)
+            self.colorTable.extend((r, g, b, a) for b, g, r, a in palette.tolist())
+
+        # Padded with black so out of range indices from malformed files stay safe
+        self._palette_rgb = np.zeros((max(256, len(self.colorTable)), 3), dtype=np.uint8)
+        if self.colorTable:
+            self._palette_rgb[:len(self.colorTable)] = palette[:, 2::-1]
+
+        logger.debug("bmp %s: %dx%d bpp=%d size=%d offset=%d palette=%d", self.filename,
+                     self.width, self.height, self.bpp, self.fileSize, self.dataOffset, len(self.colorTable))
 
     def generatePixelGrid(self):
         if self.bpp == 1:
@@ -70,140 +140,84 @@ class BMPFile:
         elif self.bpp == 24:
             return self._parse_24bpp()
         else:
-            print(f"BPP={self.bpp} not supported yet")
-            exit(1)
-
-    def _row_stride(self):
-        return ((self.bpp * self.width + 31) // 32) * 4
-
-    def _is_top_down(self):
-        return self.height < 0
-
-    def _abs_height(self):
-        return abs(self.height)
+            raise ValueError(f"BPP={self.bpp} not supported yet")
+
+    def _pixel_rows(self):
+        # Whole pixel array as a (H, stride) uint8 view (a copy if the last row's padding
+        # is missing from the file), top row first
+        stride = self.rowStride
+        H = self.absHeight
+        size = len(self.bytes) - self.dataOffset
+        if size >= stride * H:
+            rows = np.frombuffer(self.bytes, dtype=np.uint8, count=stride * H, offset=self.dataOffset)
+        elif size >= stride * (H - 1) + (self.bpp * self.width + 7) // 8:
+            # Some writers leave out the last row's padding. Copy into a zero padded buffer
+            # so the rows still have one stride
+            rows = np.zeros(stride * H, dtype=np.uint8)
+            rows[:size] = np.frombuffer(self.bytes, dtype=np.uint8, count=size, offset=self.dataOffset)
+        else:
+            raise ValueError("BMP pixel data truncated")
+        rows = rows.reshape(H, stride)
+        return rows if self.topDown else rows[::-1]
 
 
 
     def _parse_1bpp(self):
 
         if len(self.colorTable) != 2:
-            print(f"Expected 2 color table entries for 1-bit BMP, got {len(self.colorTable)}")
-            exit(1)
-
-        stride = self._row_stride()
-        H = self._abs_height()
-        top_down = self._is_top_down()
-
-        color0 = self.colorTable[0]
-        color1 = self.colorTable[1]
-
-        grid = []
-        for y in range(H):
-            src_row = y if top_down else (H - 1 - y)
-            row_offset = self.dataOffset + src_row * stride
-            row_pixels = []
-            for x in range(self.width):
-                byte_index = x // 8
-                bit_index = 7 - (x % 8)
-                byte_value = self.bytes[row_offset + byte_index]
-                bit = (byte_value >> bit_index) & 1
-                c = color1 if bit else color0
-                row_pixels.append((c[0], c[1], c[2]))
-            grid.append(row_pixels)
+            raise ValueError(f"Expected 2 color table entries for 1-bit BMP, got {len(self.colorTable)}")
+
+        if HAVE_NUMBA:
+            grid = _unpack_rows(self._pixel_rows(), self.width, 1, self._palette_rgb)
+        else:
+            # MSB first, one bit per pixel: bit 0 -> colorTable[0], 1 -> colorTable[1]
+            bits = np.unpackbits(self._pixel_rows(), axis=1)[:, :self.width]
+            grid = self._palette_rgb[bits]
 
         self.pixelmap = grid
         return grid
 
     def _parse_4bpp(self):
         if len(self.colorTable) == 0:
-            print("4bpp BMP requires a color table (palette)")
-            exit(1)
-
-        stride = self._row_stride()  # ((bpp*width + 31)//32)*4
-        H = self._abs_height()
-        top_down = self._is_top_down()
-
-        grid = []
-        for y in range(H):
-            src_row = y if top_down else (H - 1 - y)
-            row_offset = self.dataOffset + src_row * stride
-            row_pixels = []
-
-            for x in range(self.width):
-                byte_val = self.bytes[row_offset + (x // 2)]
-                if (x % 2) == 0:
-                    idx = (byte_val >> 4) & 0x0F
-                else:
-                    idx = byte_val & 0x0F
-
-                if idx < len(self.colorTable):
-                    r, g, b, _a = self.colorTable[idx]
-                else:
-                    r, g, b = 0, 0, 0  # guard against malformed palette/index
-                row_pixels.append((r, g, b))
-            grid.append(row_pixels)
+            raise ValueError("4bpp BMP requires a color table (palette)")
+
+        raw = self._pixel_rows()
+        if HAVE_NUMBA:
+            grid = _unpack_rows(raw, self.width, 4, self._palette_rgb)
+        else:
+            # Two pixels per byte, high nibble first. Interleave hi/lo back into pixel order
+            idx = np.empty((raw.shape[0], raw.shape[1] * 2), dtype=np.uint8)
+            idx[:, 0::2] = raw >> 4
+            idx[:, 1::2] = raw & 0x0F
+            grid = self._palette_rgb[idx[:, :self.width]]
 
         self.pixelmap = grid
         return grid
 
     def _parse_8bpp(self):
         if len(self.colorTable) == 0:
-            print("8bpp BMP requires a color table (palette)")
-            exit(1)
-
-        stride = self._row_stride()
-        H = self._abs_height()
-        top_down = self._is_top_down()
-
-        grid = []
-        for y in range(H):
-            src_row = y if top_down else (H - 1 - y)
-            row_offset = self.dataOffset + src_row * stride
-            row_pixels = []
-            # Each byte is an index into the palette
-            for x in range(self.width):
-                idx = self.bytes[row_offset + x]
-                if idx >= len(self.colorTable):
-                    # Guard against malformed files
-                    r, g, b = 0, 0, 0
-                else:
-                    r, g, b, _a = self.colorTable[idx]
-                row_pixels.append((r, g, b))
-            grid.append(row_pixels)
+            raise ValueError("8bpp BMP requires a color table (palette)")
+
+        if HAVE_NUMBA:
+            grid = _unpack_rows(self._pixel_rows(), self.width, 8, self._palette_rgb)
+        else:
+            # Each byte is an index into the palette, gather them all at once
+            idx = self._pixel_rows()[:, :self.width]
+            grid = self._palette_rgb[idx]
 
         self.pixelmap = grid
         return grid
 
     def _parse_24bpp(self):
         if self.compression != 0:
-            print("24bpp parser supports only BI_RGB (no compression)")
-            exit(1)
-
-        bytes_per_pixel = 3
-        stride = self._row_stride()  # ((24*width + 31)//32)*4
-        H = self._abs_height()
-        top_down = self._is_top_down()
-
-        grid = []
-        for y in range(H):
-            src_row = y if top_down else (H - 1 - y)
-            row_offset = self.dataOffset + src_row * stride
-            row_pixels = []
-
-            payload_len = self.width * bytes_per_pixel
-            end = row_offset + payload_len
-
-            # safety clamp
-            if end > len(self.bytes):
-                raise ValueError("BMP pixel data truncated")
-
-            i = row_offset
-            for _x in range(self.width):
-                b = self.bytes[i + 0]
-                g = self.bytes[i + 1]
-                r = self.bytes[i + 2]
-                row_pixels.append((r, g, b))
-                i += 3
-            grid.append(row_pixels)
+            raise ValueError("24bpp parser supports only BI_RGB (no compression)")
+
+        rows = self._pixel_rows()
+        if HAVE_NUMBA:
+            grid = _unpack_rows(rows, self.width, 24, self._palette_rgb)
+        else:
+            # rows are B,G,R triplets followed by padding up to the stride
+            grid = rows[:, :self.width * 3].reshape(-1, self.width, 3)[:, :, ::-1]
+            grid = np.ascontiguousarray(grid)
         self.pixelmap = grid
         return grid
@@ -1,10 +1,17 @@
+from concurrent.futures import ThreadPoolExecutor
+import itertools
+import struct
+import numpy as np
 from bmpfile import BMPFile
+from jit import njit, HAVE_NUMBA
 
+# Range coder state is a 32-bit window: low (plus one carry bit) and range.
+# range is topped up a whole byte at a time whenever it drops below TOP
 CODE_BITS = 32
 FULL_RANGE = 1 << CODE_BITS #2^32
-HALF       = FULL_RANGE >> 1 # 0.5
-FIRST_QTR  = HALF >> 1 # 0.25
-THIRD_QTR  = FIRST_QTR * 3 # 0.75
+TOP = 1 << 24
+RESCALE_LIMIT = 1_000_000 # halve all counts once a single symbol passes this
+MAX_TOTAL = TOP # every symbol needs at least 1 unit of range, so total <= the smallest range
 
 
 # Inspired by this: https://www.sfu.ca/~jiel/courses/861/ref/LOCOI.pdf
@@ -12,54 +19,54 @@ THIRD_QTR  = FIRST_QTR * 3 # 0.75
 class FrequencyTable:
     # Maintains:
     # freq[s] >= 1 for each symbol
-    # cumulative table cum[i] = sum_{s < i} freq[s]
+    # Fenwick tree over freq[]: tree[i] = sum of freq over the block of i & -i symbols
+    # ending at symbol i-1, so cumulative counts, updates and the symbol search are
+    # all O(log N) and nothing has to be rebuilt per symbol
 
     def __init__(self, symbol_count):
         self.symbol_count = symbol_count
         self.freq = [1] * symbol_count # start with uniform counts
-        self.cum = None # cumulative table
+        self.tree = None # Fenwick tree, 1-indexed
         self.total = symbol_count # sum(freq)
-    
-    def _rebuild_cumulative(self):
-        #Rebuilds cumulative frequencies from freq[]
-        self.cum = [0] * (self.symbol_count + 1)
-        s = 0
-        for i in range(self.symbol_count):
-            self.cum[i] = s
-            s += self.freq[i]
-        self.cum[self.symbol_count] = s
-        self.total = s
-
-    def _ensure_cum(self):
-        if self.cum is None:
-            self._rebuild_cumulative()
-
+        self._top_step = 1 << (symbol_count.bit_length() - 1) # largest power of 2 <= N
+        self._build_tree()
+
+    def _build_tree(self):
+        # O(N) build from freq[], only needed at the start and after a rescale
+        n = self.symbol_count
+        tree = [0] * (n + 1)
+        for i in range(1, n + 1):
+            tree[i] += self.freq[i - 1]
+            parent = i + (i & -i)
+            if parent <= n:
+                tree[parent] += tree[i]
+        self.tree = tree
+        self.total = sum(self.freq)
 
     def get_total(self):
-        self._ensure_cum()
         return self.total
 
-    def get_low_high(self, symbol):
-        # Returns (low, high) cumulative counts for the given symbol
-        # low = sum_{s < symbol} freq[s]
-        # high = sum_{s <= symbol} freq[s]
-
-        self._ensure_cum()
-        return self.cum[symbol], self.cum[symbol + 1]
-
-    def get_symbol_for_value(self, value):
-        # Given value in [0, total-1], returns the symbol such that:
-        # cum[symbol] <= value < cum[symbol+1]
-
-        self._ensure_cum()
-        lo, hi = 0, self.symbol_count
-        while lo + 1 < hi:
-            mid = (lo + hi) // 2
-            if self.cum[mid] > value:
-                hi = mid
-            else:
-                lo = mid
-        return lo
+    def find(self, value):
+        # Given value in [0, total-1], returns (symbol, low, high) such that:
+        # low = cum[symbol] <= value < cum[symbol+1] = high
+        # Walks the tree from the largest step down instead of searching a cum table.
+        # The blocks it steps over add up to cum[symbol], so low comes for free
+
+        if value >= self.total:
+            # Only a damaged stream gets here, the descent would run off the table
+            raise ValueError("corrupt stream")
+        tree = self.tree
+        n = self.symbol_count
+        pos = 0
+        low = 0
+        step = self._top_step
+        while step:
+            nxt = pos + step
+            if nxt <= n and low + tree[nxt] <= value:
+                pos = nxt
+                low += tree[nxt]
+            step >>= 1
+        return pos, low, low + self.freq[pos]
 
     def increment(self, symbol):
         # Increment frequency of the given symbol
@@ -67,146 +74,234 @@ class FrequencyTable:
 
         self.freq[symbol] += 1
         # When a single symbol grows large, total will too
-        # Rescale to keep totals reasonable
-        if self.freq[symbol] > 1_000_000:
+        # Rescale to keep totals reasonable, and within what the range coder can split
+        if self.freq[symbol] > RESCALE_LIMIT or self.total >= MAX_TOTAL:
             # Halve all frequencies but keep >=1
-            for i in range(self.symbol_count):
-                f = self.freq[i]
-                f = (f + 1) // 2
-                if f < 1:
-                    f = 1
-                self.freq[i] = f
-        # Mark cumulative as dirty
-        self.cum = None
-
+            self.freq = [(f + 1) // 2 for f in self.freq]
+            self._build_tree()
+            return
 
+        tree = self.tree
+        n = self.symbol_count
+        i = symbol + 1
+        while i <= n:
+            tree[i] += 1
+            i += i & -i
+        self.total += 1
 
 
-class ArithmeticEncoder:
-    def __init__(self):
-        self.low = 0
-        self.high = FULL_RANGE - 1
-        self.pending = 0
-        self.output_bits = []
-
-    def _output_bit(self, bit):
-        # Output 1 bit, then flush pending opposite bits
-        self.output_bits.append(bit)
-        while self.pending > 0:
-            self.output_bits.append(1 - bit)
-            self.pending -= 1
-
-    def encode_symbol(self, model: FrequencyTable, symbol: int):
-        total = model.get_total()
-        sym_low, sym_high = model.get_low_high(symbol)
-
-        range_ = self.high - self.low + 1
-        self.high = self.low + (range_ * sym_high // total) - 1
-        self.low  = self.low + (range_ * sym_low  // total)
-
-        # E1, E2, E3 scaling
-        while True:
-            # E1: MSB 0
-            if self.high < HALF:
-                self._output_bit(0)
-                self.low  = self.low * 2
-                self.high = self.high * 2 + 1
-            # E2: MSB 1
-            elif self.low >= HALF:
-                self._output_bit(1)
-                self.low  = (self.low - HALF) * 2
-                self.high = (self.high - HALF) * 2 + 1
-            # E3
-            elif self.low >= FIRST_QTR and self.high < THIRD_QTR:
-                self.pending += 1
-                self.low  = (self.low - FIRST_QTR) * 2
-                self.high = (self.high - FIRST_QTR) * 2 + 1
-            else:
-                break
-
-        model.increment(symbol)
-
-    def finish(self):
-        self.pending += 1
-        if self.low < FIRST_QTR:
-            self._output_bit(0)
-        else:
-            self._output_bit(1)
-        return self.output_bits
 
 
 class ArithmeticDecoder:
-    def __init__(self, bitstream):
-        self.bitstream = bitstream
+    def __init__(self, data):
+        # data is the byte stream from encode_symbols
+        self.data = bytes(data)
         self.pos = 0
-        self.low = 0
-        self.high = FULL_RANGE - 1
+        self.range = FULL_RANGE - 1
+        # code = (stream value - low) within the current 32-bit window
         self.code = 0
 
-        # Init code with first CODE_BITS bits
-        for _ in range(CODE_BITS):
-            self.code = (self.code << 1) | self._read_bit()
+        # Init code with the first CODE_BITS bits
+        for _ in range(CODE_BITS // 8):
+            self.code = (self.code << 8) | self._read_byte()
 
-    def _read_bit(self):
-        if self.pos >= len(self.bitstream):
+    def _read_byte(self):
+        if self.pos >= len(self.data):
             # Past end of stream: pad with zeroes
             return 0
-        b = self.bitstream[self.pos]
+        b = self.data[self.pos]
         self.pos += 1
         return b
 
     def decode_symbol(self, model: FrequencyTable) -> int:
         total = model.get_total()
-        range_ = self.high - self.low + 1
-
-        value = ((self.code - self.low + 1) * total - 1) // range_
-
-        symbol = model.get_symbol_for_value(value)
-        sym_low, sym_high = model.get_low_high(symbol)
-
-        self.high = self.low + (range_ * sym_high // total) - 1
-        self.low  = self.low + (range_ * sym_low  // total)
-
-        # E1, E2, E3 scaling
-        while True:
-            if self.high < HALF:
-                # E1
-                self.low  = self.low * 2
-                self.high = self.high * 2 + 1
-                self.code = (self.code * 2) + self._read_bit()
-            elif self.low >= HALF:
-                # E2
-                self.low  = (self.low - HALF) * 2
-                self.high = (self.high - HALF) * 2 + 1
-                self.code = (self.code - HALF) * 2 + self._read_bit()
-            elif self.low >= FIRST_QTR and self.high < THIRD_QTR:
-                # E3
-                self.low  = (self.low - FIRST_QTR) * 2
-                self.high = (self.high - FIRST_QTR) * 2 + 1
-                self.code = (self.code - FIRST_QTR) * 2 + self._read_bit()
-            else:
-                break
+        range_ = self.range
+
+        value = ((self.code + 1) * total - 1) // range_
+
+        symbol, sym_low, sym_high = model.find(value)
+
+        r_low = range_ * sym_low // total
+        self.code -= r_low
+        self.range = range_ * sym_high // total - r_low
+
+        # Renormalize a byte at a time
+        while self.range < TOP:
+            self.range <<= 8
+            self.code = (self.code << 8) | self._read_byte()
 
         model.increment(symbol)
         return symbol
 
+    def decode_pixel(self, models):
+        # Same as decode_symbol(models[c]) for each channel, but with the coder state in
+        # locals and _read_byte inlined. Returns (dr, dg, db)
+        range_ = self.range
+        code = self.code
+        pos = self.pos
+        data = self.data
+        n = len(data)
+
+        symbols = []
+        for model in models:
+            total = model.total
+
+            value = ((code + 1) * total - 1) // range_
+
+            symbol, sym_low, sym_high = model.find(value)
+
+            r_low = range_ * sym_low // total
+            code -= r_low
+            range_ = range_ * sym_high // total - r_low
+
+            while range_ < TOP:
+                range_ <<= 8
+                code <<= 8
+                if pos < n:
+                    code |= data[pos]
+                    pos += 1
+                # Past end of stream: pad with zeroes
+
+            model.increment(symbol)
+            symbols.append(symbol)
+
+        self.range = range_
+        self.code = code
+        self.pos = pos
+        return symbols
+
+
+
+# Array versions of the FrequencyTable operations for the jitted coder below.
+# Several models sit back to back in flat arrays: with N symbols, model m's freq
+# starts at f0 = m * N and its tree at t0 = m * (N + 1)
+
+@njit(cache=True)
+def _fenwick_build(freq, tree, f0, t0, n):
+    # Rebuilds tree[t0:t0 + n + 1] from freq[f0:f0 + n], returns the total
+    total = 0
+    for i in range(n + 1):
+        tree[t0 + i] = 0
+    for i in range(1, n + 1):
+        f = freq[f0 + i - 1]
+        total += f
+        tree[t0 + i] += f
+        parent = i + (i & -i)
+        if parent <= n:
+            tree[t0 + parent] += tree[t0 + i]
+    return total
+
+
+@njit(cache=True)
+def _fenwick_prefix(tree, t0, i):
+    # sum_{s < i} freq[s]
+    s = 0
+    while i > 0:
+        s += tree[t0 + i]
+        i -= i & -i
+    return s
+
+
+@njit(cache=True)
+def _fenwick_add(tree, t0, n, i, delta):
+    # freq[i] += delta
+    i += 1
+    while i <= n:
+        tree[t0 + i] += delta
+        i += i & -i
+
+
+@njit(cache=True)
+def _models_init(model_count, n):
+    # freq, tree and total for model_count fresh FrequencyTables
+    freq = np.ones(model_count * n, dtype=np.int64)
+    tree = np.zeros(model_count * (n + 1), dtype=np.int64)
+    total = np.empty(model_count, dtype=np.int64)
+    for m in range(model_count):
+        total[m] = _fenwick_build(freq, tree, m * n, m * (n + 1), n)
+    return freq, tree, total
+
+
+@njit(cache=True)
+def _grow(buf, needed):
+    out = np.zeros(max(needed, 2 * buf.shape[0]), dtype=buf.dtype)
+    out[:buf.shape[0]] = buf
+    return out
+
+
+@njit(cache=True)
+def _shift_low(out, pos, low, cache, cache_size):
+    # Move the top byte of low out into out[pos:], returns the updated state.
+    # The newest byte is held back in cache, along with cache_size - 1 0xFF bytes after
+    # it, until it's known whether a carry out of low still has to ripple into them
+    if low < 0xFF000000 or low >= FULL_RANGE:
+        carry = low >> CODE_BITS
+        if pos + cache_size > out.shape[0]:
+            out = _grow(out, pos + cache_size)
+        out[pos] = (cache + carry) & 0xFF
+        pos += 1
+        out[pos:pos + cache_size - 1] = (0xFF + carry) & 0xFF
+        pos += cache_size - 1
+        cache_size = 0
+        cache = (low >> 24) & 0xFF
+    return out, pos, (low & 0x00FFFFFF) << 8, cache, cache_size + 1
+
+
+@njit(cache=True, nogil=True, boundscheck=False)
+def encode_symbols(symbols, contexts, symbol_count, model_count):
+    # Range codes a whole 1-D symbol array in one call, with the same model updates as
+    # FrequencyTable, so ArithmeticDecoder reads it back.
+    # Symbol k is coded with model contexts[k], one of model_count.
+    # Returns the byte stream as a uint8 array.
+    # int64 is enough: range_ < 2^32 and total <= MAX_TOTAL = 2^24
+    n = symbol_count
+    freq, tree, total = _models_init(model_count, n)
+
+    out = np.zeros(symbols.shape[0] // 4 + 16, dtype=np.uint8)
+    pos = 0 # bytes written
+    low = 0
+    range_ = FULL_RANGE - 1
+    cache = 0
+    cache_size = 1
+
+    for k in range(symbols.shape[0]):
+        m = np.int64(contexts[k])
+        f0 = m * n
+        t0 = m * (n + 1)
+        symbol = np.int64(symbols[k]) # symbols may be uint8
+        sym_low = _fenwick_prefix(tree, t0, symbol)
+        sym_high = sym_low + freq[f0 + symbol]
+
+        t = total[m]
+        r_low = range_ * sym_low // t
+        low += r_low
+        range_ = range_ * sym_high // t - r_low
+
+        while range_ < TOP:
+            range_ <<= 8
+            out, pos, low, cache, cache_size = _shift_low(out, pos, low, cache, cache_size)
+
+        # model.increment(symbol)
+        freq[f0 + symbol] += 1
+        if freq[f0 + symbol] > RESCALE_LIMIT or t >= MAX_TOTAL:
+            for i in range(n):
+                freq[f0 + i] = (freq[f0 + i] + 1) // 2
+            total[m] = _fenwick_build(freq, tree, f0, t0, n)
+        else:
+            _fenwick_add(tree, t0, n, symbol, 1)
+            total[m] = t + 1
 
+    # Flush the cached byte and all 4 bytes of low
+    for _ in range(5):
+        out, pos, low, cache, cache_size = _shift_low(out, pos, low, cache, cache_size)
 
-def loco_predictor(x, y, grid):
-    # LOCO-I predictor
-    # For borders, return 0 or nearest neighbor
-
-    if x == 0 and y == 0:
-        return (0, 0, 0)
-    if x == 0:
-        return grid[y - 1][x]
-    if y == 0:
-        return grid[y][x - 1]
+    # The very first byte out is the initial empty cache, always 0, skip it
+    return out[1:pos].copy()
 
-    L = grid[y][x - 1]
-    T = grid[y - 1][x]
-    TL = grid[y - 1][x - 1]
 
+def _loco_interior(L, T, TL):
+    # LOCO-I prediction for a pixel with all three neighbours, as plain ints per channel:
+    # median of L, T and L + T - TL
     pred = []
     for c in range(3):
         l, t, tl = L[c], T[c], TL[c]
@@ -218,65 +313,397 @@ def loco_predictor(x, y, grid):
 
 # ===============================================================
 
-MAX_RESIDUAL = 510
-SYMBOL_COUNT = MAX_RESIDUAL + 1
-
-
-def compress_image(pixelmap):
-    # Compress full pixel grid
-    H = len(pixelmap)
-    W = len(pixelmap[0])
-
-    encoder = ArithmeticEncoder()
-    model = FrequencyTable(SYMBOL_COUNT)
-
-    # copy
-    pred_grid = [[(0, 0, 0)] * W for _ in range(H)]
-
+MAX_RESIDUAL = 255 # |pixel - prediction|
+TILE_SIZE = 256
+
+# Residuals are zigzag mapped (0, -1, 1, -2, 2, ... -> 0, 1, 2, 3, 4, ...) into
+# [0, 2 * MAX_RESIDUAL], so a good prediction gives a small value. Values below ESCAPE
+# are coded as they are, larger ones as ESCAPE followed by value - ESCAPE in two
+# TAIL_BITS pieces, each with a model of its own. That keeps the alphabet small,
+# so the models are quick to learn and the Fenwick walks short
+TAIL_BITS = 6
+SYMBOL_COUNT = 1 << TAIL_BITS
+ESCAPE = SYMBOL_COUNT - 1
+
+# Every channel of a pixel is coded under a context from its local gradients |L - TL| and
+# |T - TL|, each quantized into GRADIENT_BINS bins (0, 1-2, 3-5, 6-15, 16+), so flat
+# areas, edges and texture each get their own model. Pixels on the first row or column
+# of a tile don't have all neighbours and share BORDER_CONTEXT
+GRADIENT_THRESHOLDS = (0, 2, 5, 15)
+GRADIENT_BINS = len(GRADIENT_THRESHOLDS) + 1
+BORDER_CONTEXT = GRADIENT_BINS * GRADIENT_BINS
+CONTEXT_COUNT = BORDER_CONTEXT + 1
+# bin of every possible difference
+_GRADIENT_BIN = np.searchsorted(GRADIENT_THRESHOLDS, np.arange(256)).astype(np.int64)
+_GRADIENT_BIN_LIST = _GRADIENT_BIN.tolist()
+
+# Models for the two pieces of an escaped value, after the contexts
+TAIL_HIGH = CONTEXT_COUNT
+TAIL_LOW = CONTEXT_COUNT + 1
+MODEL_COUNT = CONTEXT_COUNT + 2
+
+
+@njit(cache=True)
+def _loco_jit(l, t, tl):
+    # _loco_interior for one channel, all int32.
+    # Pixels are widened explicitly by the callers, numba's int() of a uint8 is unsigned
+    p = l + t - tl
+    return max(min(p, max(l, t)), min(l, t))
+
+
+@njit(cache=True)
+def _context_jit(l, t, tl):
+    # Context of one interior channel, int32 neighbours like _loco_jit
+    return _GRADIENT_BIN[abs(l - tl)] * GRADIENT_BINS + _GRADIENT_BIN[abs(t - tl)]
+
+
+@njit(cache=True)
+def _zigzag_jit(d):
+    # int32 residual in [-MAX_RESIDUAL, MAX_RESIDUAL] -> [0, 2 * MAX_RESIDUAL]
+    return (d << 1) ^ (d >> 31)
+
+
+@njit(cache=True, nogil=True, boundscheck=False)
+def _compute_residuals_jit(pix):
+    # Zigzag mapped LOCO-I residuals for a (H, W, 3) uint8 image
+    # Same prediction as _loco_interior. It only reads causal neighbours, which are
+    # equal to the original pixels, so no separate prediction grid is needed.
+    # The first row and column are done outside the main loop, so it has no border checks.
+    # pred is always in [0, 255], so the residuals need no clamping
+    H, W, C = pix.shape
+    out = np.empty((H, W, C), dtype=np.uint16)
+    if H == 0 or W == 0:
+        return out
+
+    # first row predicts from the left neighbour, 0 for the very first pixel
+    for c in range(C):
+        out[0, 0, c] = _zigzag_jit(np.int32(pix[0, 0, c]))
+    for x in range(1, W):
+        for c in range(C):
+            out[0, x, c] = _zigzag_jit(np.int32(pix[0, x, c]) - np.int32(pix[0, x - 1, c]))
+
+    for y in range(1, H):
+        # first column predicts from above
+        for c in range(C):
+            out[y, 0, c] = _zigzag_jit(np.int32(pix[y, 0, c]) - np.int32(pix[y - 1, 0, c]))
+        for x in range(1, W):
+            for c in range(C):
+                p = _loco_jit(np.int32(pix[y, x - 1, c]), np.int32(pix[y - 1, x, c]),
+                              np.int32(pix[y - 1, x - 1, c]))
+                out[y, x, c] = _zigzag_jit(np.int32(pix[y, x, c]) - p)
+    return out
+
+
+@njit(cache=True, nogil=True, boundscheck=False)
+def decode_tile(data, height, width):
+    # Inverse of compress_image for one tile, returns its (height, width, 3) uint8 pixels.
+    # The context of every symbol comes from pixels decoded before it, so they're
+    # rebuilt right in the decoding loop, in scan order.
+    # Same steps as ArithmeticDecoder.decode_symbol and FrequencyTable.find
+    n = SYMBOL_COUNT
+    freq, tree, total = _models_init(MODEL_COUNT, n)
+    top_step = 1 # largest power of 2 <= N
+    while top_step * 2 <= n:
+        top_step *= 2
+
+    size = data.shape[0]
+    pos = 0
+    range_ = FULL_RANGE - 1
+    code = 0
+    # Init code with the first CODE_BITS bits, zeroes past the end
+    for _ in range(CODE_BITS // 8):
+        code <<= 8
+        if pos < size:
+            code |= np.int64(data[pos])
+            pos += 1
+
+    pix = np.empty((height, width, 3), dtype=np.uint8)
+    # prediction, context and zigzag value of the current pixel's channels
+    pred = np.empty(3, dtype=np.int32)
+    ctx = np.empty(3, dtype=np.int64)
+    values = np.empty(3, dtype=np.int64)
+    for y in range(height):
+        for x in range(width):
+            # Prediction and context, as in _compute_residuals_jit and _compute_contexts
+            for c in range(3):
+                if y > 0 and x > 0:
+                    l = np.int32(pix[y, x - 1, c])
+                    t = np.int32(pix[y - 1, x, c])
+                    tl = np.int32(pix[y - 1, x - 1, c])
+                    pred[c] = _loco_jit(l, t, tl)
+                    ctx[c] = _context_jit(l, t, tl)
+                else:
+                    ctx[c] = BORDER_CONTEXT
+                    if x > 0:
+                        pred[c] = pix[y, x - 1, c]
+                    elif y > 0:
+                        pred[c] = pix[y - 1, x, c]
+                    else:
+                        pred[c] = 0
+
+            # The pixel's symbols in _symbol_stream_jit's order: slots 0-2 are the channels,
+            # 3-8 the high and low tail pieces of each, only there if it was escaped.
+            # One loop keeps a single copy of the decoding step
+            for j in range(9):
+                if j < 3:
+                    c = j
+                    m = ctx[c]
+                else:
+                    c = (j - 3) >> 1
+                    if values[c] < ESCAPE:
+                        continue
+                    m = TAIL_HIGH if (j - 3) & 1 == 0 else TAIL_LOW
+
+                f0 = m * n
+                t0 = m * (n + 1)
+                tot = total[m]
+                value = ((code + 1) * tot - 1) // range_
+                if value >= tot:
+                    # Damaged stream. Same error as FrequencyTable.find, without it the
+                    # descent lands on symbol n, past the model's table
+                    raise ValueError("corrupt stream")
+
+                # Fenwick descent, see FrequencyTable.find
+                symbol = 0
+                sym_low = 0
+                step = top_step
+                while step:
+                    nxt = symbol + step
+                    if nxt <= n and sym_low + tree[t0 + nxt] <= value:
+                        symbol = nxt
+                        sym_low += tree[t0 + nxt]
+                    step >>= 1
+                sym_high = sym_low + freq[f0 + symbol]
+
+                r_low = range_ * sym_low // tot
+                code -= r_low
+                range_ = range_ * sym_high // tot - r_low
+
+                while range_ < TOP:
+                    range_ <<= 8
+                    code <<= 8
+                    if pos < size:
+                        code |= np.int64(data[pos])
+                        pos += 1
+
+                if j < 3:
+                    values[c] = symbol
+                elif m == TAIL_HIGH:
+                    values[c] += symbol << TAIL_BITS
+                else:
+                    values[c] += symbol
+
+                # model.increment(symbol)
+                freq[f0 + symbol] += 1
+                if freq[f0 + symbol] > RESCALE_LIMIT or tot >= MAX_TOTAL:
+                    for i in range(n):
+                        freq[f0 + i] = (freq[f0 + i] + 1) // 2
+                    total[m] = _fenwick_build(freq, tree, f0, t0, n)
+                else:
+                    _fenwick_add(tree, t0, n, symbol, 1)
+                    total[m] = tot + 1
+
+            for c in range(3):
+                # undo the zigzag
+                u = values[c]
+                pix[y, x, c] = pred[c] + ((u >> 1) ^ -(u & 1))
+
+    return pix
+
+
+def _compute_residuals_np(pix):
+    # Same residuals as _compute_residuals_jit, for the whole image at once.
+    # Every neighbour is an original pixel, so L/T/TL are just shifted views
+    img = pix.astype(np.int16)
+    pred = np.empty_like(img)
+
+    # (:1 slices so empty images work too)
+    pred[:1, :1] = 0
+    # first row predicts from the left neighbour, first column from above
+    pred[:1, 1:] = img[:1, :-1]
+    pred[1:, :1] = img[:-1, :1]
+
+    L, T, TL = img[1:, :-1], img[:-1, 1:], img[:-1, :-1]
+    pred[1:, 1:] = np.clip(L + T - TL, np.minimum(L, T), np.maximum(L, T))
+
+    # pred is always in [0, 255], so d fits an int16 even shifted left
+    d = img - pred
+    return ((d << 1) ^ (d >> 15)).astype(np.uint16)
+
+
+def _compute_contexts(pix):
+    # Context of every channel of a (H, W, 3) uint8 image, the same ones decode_tile
+    # derives from the pixels it has decoded
+    img = pix.astype(np.int16)
+    ctx = np.full(img.shape, BORDER_CONTEXT, dtype=np.uint8)
+    L, T, TL = img[1:, :-1], img[:-1, 1:], img[:-1, :-1]
+    ctx[1:, 1:] = _GRADIENT_BIN[np.abs(L - TL)] * GRADIENT_BINS + _GRADIENT_BIN[np.abs(T - TL)]
+    return ctx
+
+
+@njit(cache=True, nogil=True, boundscheck=False)
+def _symbol_stream_jit(pix):
+    # The symbols of a (H, W, 3) uint8 tile and the model of each, in the order
+    # decode_tile reads them: per pixel its three channels, then the high and low tail
+    # pieces of every escaped one
+    H, W, C = pix.shape
+    values = _compute_residuals_jit(pix)
+    symbols = np.empty(H * W * 3 * 3, dtype=np.uint8)
+    models = np.empty(H * W * 3 * 3, dtype=np.uint8)
+    k = 0
     for y in range(H):
         for x in range(W):
-            pr, pg, pb = loco_predictor(x, y, pred_grid)
-            r, g, b = pixelmap[y][x]
-
-            dr = r - pr + 255
-            dg = g - pg + 255
-            db = b - pb + 255
-
-            # safety clamp 
-            dr = max(0, min(MAX_RESIDUAL, dr))
-            dg = max(0, min(MAX_RESIDUAL, dg))
-            db = max(0, min(MAX_RESIDUAL, db))
-
-            encoder.encode_symbol(model, dr)
-            encoder.encode_symbol(model, dg)
-            encoder.encode_symbol(model, db)
-
-            pred_grid[y][x] = (r, g, b)
-
-    return encoder.finish()
-
-
-def decompress_image(bitstream, width, height):
-    # Decompress into pixel grid 
-    decoder = ArithmeticDecoder(bitstream)
-    model = FrequencyTable(SYMBOL_COUNT)
-
-    grid = [[(0, 0, 0)] * width for _ in range(height)]
-
+            for c in range(C):
+                if y > 0 and x > 0:
+                    m = _context_jit(np.int32(pix[y, x - 1, c]), np.int32(pix[y - 1, x, c]),
+                                     np.int32(pix[y - 1, x - 1, c]))
+                else:
+                    m = BORDER_CONTEXT
+                symbols[k] = min(values[y, x, c], ESCAPE)
+                models[k] = m
+                k += 1
+            for c in range(C):
+                rest = np.int32(values[y, x, c]) - ESCAPE
+                if rest >= 0:
+                    symbols[k] = rest >> TAIL_BITS
+                    models[k] = TAIL_HIGH
+                    symbols[k + 1] = rest & (SYMBOL_COUNT - 1)
+                    models[k + 1] = TAIL_LOW
+                    k += 2
+    return symbols[:k], models[:k]
+
+
+def _symbol_stream_np(pix):
+    # Same stream as _symbol_stream_jit. Every pixel gets all 9 slots, then the tail ones
+    # of channels that weren't escaped are dropped
+    values = _compute_residuals_np(pix).reshape(-1, 3).astype(np.int64)
+    rest = values - ESCAPE
+
+    symbols = np.empty((len(values), 9), dtype=np.int64)
+    models = np.empty((len(values), 9), dtype=np.uint8)
+    symbols[:, :3] = np.minimum(values, ESCAPE)
+    symbols[:, 3::2] = rest >> TAIL_BITS
+    symbols[:, 4::2] = rest & (SYMBOL_COUNT - 1)
+    models[:, :3] = _compute_contexts(pix).reshape(-1, 3)
+    models[:, 3::2] = TAIL_HIGH
+    models[:, 4::2] = TAIL_LOW
+
+    keep = np.ones((len(values), 9), dtype=bool)
+    keep[:, 3::2] = keep[:, 4::2] = rest >= 0
+    return symbols[keep].astype(np.uint8), models[keep]
+
+
+# Without numba the jitted loop would run as plain Python, the NumPy version is far faster then
+symbol_stream = _symbol_stream_jit if HAVE_NUMBA else _symbol_stream_np
+
+
+def _tiles(height, width, tile_size):
+    # (y0, y1, x0, x1) of every tile, in raster order
+    return [(y, min(y + tile_size, height), x, min(x + tile_size, width))
+            for y in range(0, height, tile_size)
+            for x in range(0, width, tile_size)]
+
+
+def _map_tiles(func, items, progress=None):
+    # The kernels release the GIL, so with numba tiles are coded on all cores.
+    # progress(done, total) is called after every tile, from whichever thread coded it
+    if progress is not None:
+        counter = itertools.count(1)
+        code_tile = func
+
+        def func(item):
+            result = code_tile(item)
+            progress(next(counter), len(items))
+            return result
+
+    if HAVE_NUMBA and len(items) > 1:
+        with ThreadPoolExecutor() as pool:
+            return list(pool.map(func, items))
+    return [func(item) for item in items]
+
+
+def compress_image(pixelmap, tile_size=TILE_SIZE, progress=None):
+    # Compress full pixel grid
+    # The image is coded as tile_size x tile_size tiles. Each one is predicted and modelled
+    # on its own, as if it were a whole image, so they can be coded and decoded in parallel.
+    # Output: tile_size (u32), byte length of every tile (u32 each), then the tile streams
+    # progress: optional progress(tiles_done, tile_count) callback
+    pix = np.ascontiguousarray(pixelmap, dtype=np.uint8)
+    height, width = pix.shape[:2]
+
+    def encode_tile(bounds):
+        y0, y1, x0, x1 = bounds
+        symbols, models = symbol_stream(np.ascontiguousarray(pix[y0:y1, x0:x1]))
+        return encode_symbols(symbols, models, SYMBOL_COUNT, MODEL_COUNT)
+
+    streams = _map_tiles(encode_tile, _tiles(height, width, tile_size), progress)
+
+    header = struct.pack(f"<I{len(streams)}I", tile_size, *(len(s) for s in streams))
+    return header + b"".join(s.tobytes() for s in streams)
+
+
+def _decode_tile_py(chunk, height, width):
+    # decode_tile with the Python coder. Rows are rebuilt as lists of int lists,
+    # predicting from the row above
+    decoder = ArithmeticDecoder(chunk)
+    models = [FrequencyTable(SYMBOL_COUNT) for _ in range(MODEL_COUNT)]
+    border = [models[BORDER_CONTEXT]] * 3
+    tail_high, tail_low = models[TAIL_HIGH], models[TAIL_LOW]
+    bins = _GRADIENT_BIN_LIST
+
+    rows = []
+    up = None
     for y in range(height):
+        cur = []
         for x in range(width):
-            pr, pg, pb = loco_predictor(x, y, grid)
-
-            dr = decoder.decode_symbol(model)
-            dg = decoder.decode_symbol(model)
-            db = decoder.decode_symbol(model)
-
-            r = (dr - 255) + pr
-            g = (dg - 255) + pg
-            b = (db - 255) + pb
-
-            grid[y][x] = (r, g, b)
-
+            if y and x:
+                L, T, TL = cur[x - 1], up[x], up[x - 1]
+                pred = _loco_interior(L, T, TL)
+                values = decoder.decode_pixel(
+                    [models[bins[abs(L[c] - TL[c])] * GRADIENT_BINS + bins[abs(T[c] - TL[c])]]
+                     for c in range(3)])
+            else:
+                # first row predicts from the left neighbour, first column from above
+                pred = cur[x - 1] if x else up[0] if y else (0, 0, 0)
+                values = decoder.decode_pixel(border)
+
+            # then the tails of any escaped channels
+            pixel = []
+            for p, u in zip(pred, values):
+                if u == ESCAPE:
+                    u += decoder.decode_symbol(tail_high) << TAIL_BITS
+                    u += decoder.decode_symbol(tail_low)
+                # undo the zigzag
+                pixel.append(p + ((u >> 1) ^ -(u & 1)))
+            cur.append(pixel)
+        rows.append(cur)
+        up = cur
+    return np.array(rows, dtype=np.uint8)
+
+
+def decompress_image(data, width, height, progress=None):
+    # Decompress the tiled stream from compress_image into pixel grid
+    # progress is the same callback as there
+    data = memoryview(data)
+    tile_size, = struct.unpack_from("<I", data, 0)
+    tiles = _tiles(height, width, tile_size)
+    lengths = struct.unpack_from(f"<{len(tiles)}I", data, 4)
+
+    jobs = []
+    pos = 4 + 4 * len(tiles)
+    for (y0, y1, x0, x1), n in zip(tiles, lengths):
+        jobs.append((data[pos:pos + n], y1 - y0, x1 - x0))
+        pos += n
+
+    if HAVE_NUMBA:
+        decoded = _map_tiles(lambda job: decode_tile(np.frombuffer(job[0], dtype=np.uint8), *job[1:]),
+                             jobs, progress)
+    else:
+        decoded = _map_tiles(lambda job: _decode_tile_py(*job), jobs, progress)
+
+    grid = np.empty((height, width, 3), dtype=np.uint8)
+    for (y0, y1, x0, x1), pixels in zip(tiles, decoded):
+        grid[y0:y1, x0:x1] = pixels
     return grid
 
 
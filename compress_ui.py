@@ -1,27 +1,59 @@
 import os
-from PyQt5.QtCore import Qt
+from PyQt5.QtCore import Qt, QThread, QTimer, pyqtSignal
 from PyQt5.QtWidgets import (
-    QWidget, QVBoxLayout, QHBoxLayout,
+    QApplication, QWidget, QVBoxLayout, QHBoxLayout,
     QLabel, QPushButton, QMessageBox, QFileDialog
 )
 import time
+import numpy as np
 from bmpfile import BMPFile
 from compress import compress_image, decompress_image
 
 
+class CodecWorker(QThread):
+    # Runs compress_image/decompress_image (or loading a file, see main.py) off the GUI thread
+    progress = pyqtSignal(int, int) # tiles done, tile count
+    result = pyqtSignal(object)
+    failed = pyqtSignal(str)
+
+    def __init__(self, func, *args, parent=None):
+        super().__init__(parent)
+        self.func = func
+        self.args = args
+
+    def run(self):
+        try:
+            # Signals are queued across threads, so emitting from worker threads is fine
+            out = self.func(*self.args, progress=self.progress.emit)
+        except Exception as e:
+            self.failed.emit(str(e))
+            return
+        self.result.emit(out)
+
+
 class CompressionWidget(QWidget):
     def __init__(self, parent=None):
         super().__init__(parent)
 
         self.current_bmp: BMPFile | None = None
         self.original_grid = None
-        self.compressed_bits = None # list[int]
+        self.compressed_data = None # compressed stream bytes
         self.width = 0
         self.height = 0
         self.original_filesize = 0
         self.compression_start_time = 0
+        self._worker = None # running CodecWorker, if any
+        self._workers = set() # every CodecWorker that hasn't finished, superseded ones too
+
+        # Progress comes in once per tile, only repaint the label every 50 ms
+        self._progress_text = None
+        self._progress_timer = QTimer(self)
+        self._progress_timer.setSingleShot(True)
+        self._progress_timer.setInterval(50)
+        self._progress_timer.timeout.connect(self._show_progress)
 
         self._build_ui()
+        QApplication.instance().aboutToQuit.connect(self._wait_for_workers)
 
 
     def _build_ui(self):
@@ -86,13 +118,15 @@ class CompressionWidget(QWidget):
         self.height = abs(bmp.height)
         self.original_filesize = bmp.fileSize
 
-        if bmp.pixelmap:
+        if bmp.pixelmap is not None:
             self.original_grid = bmp.pixelmap
         else:
             self.original_grid = bmp.generatePixelGrid()
 
-        # Reset compression state
-        self.compressed_bits = None
+        # Reset compression state, results from a job still running are dropped
+        self._worker = None
+        self._set_busy(False)
+        self.compressed_data = None
         self.status_label.setText("Status: Ready to Receive Holy Actuation")
         self.size_label.setText("Compressed Size: N/A")
         self.ratio_label.setText("Compression Ratio: N/A")
@@ -103,55 +137,53 @@ class CompressionWidget(QWidget):
             self._set_status("No BMP loaded.", error=True)
             return
 
-        try:
-            self._set_status("Compressing...", busy=True)
-            self.compression_start_time = time.perf_counter()
-            bits = compress_image(self.original_grid)
-            self.compressed_bits = bits
-
-            compressed_bytes = (len(bits) + 7) // 8
-            self.size_label.setText(f"Compressed Size: {compressed_bytes} bytes")
-
-            if self.original_filesize > 0:
-                ratio = self.original_filesize / compressed_bytes if compressed_bytes > 0 else 0
-                self.ratio_label.setText(f"Compression Ratio: {ratio:.2f}x")
-                self.ogsize_label.setText(f"Original Size: {self.original_filesize} bytes")
-            else:
-                self.ratio_label.setText("Compression Ratio: N\A")
-
-            self.save_btn.setEnabled(True)
-            self._set_status("Compression Done!")
-            self.time_label.setText("Compression Time(ms): " + str((time.perf_counter() - self.compression_start_time)*1000))
-            
-        except Exception as e:
-            self._set_status(f"Compression Error: {e}", error=True)
+        self._set_status("Compressing...", busy=True)
+        self.compression_start_time = time.perf_counter()
+        self._start_worker("Compressing", self._on_compressed, "Compression Error",
+                           compress_image, self.original_grid)
+
+    def _on_compressed(self, data):
+        self.compressed_data = data
+
+        compressed_bytes = len(data)
+        self.size_label.setText(f"Compressed Size: {compressed_bytes} bytes")
+
+        if self.original_filesize > 0:
+            ratio = self.original_filesize / compressed_bytes if compressed_bytes > 0 else 0
+            self.ratio_label.setText(f"Compression Ratio: {ratio:.2f}x")
+            self.ogsize_label.setText(f"Original Size: {self.original_filesize} bytes")
+        else:
+            self.ratio_label.setText("Compression Ratio: N\A")
+
+        self.save_btn.setEnabled(True)
+        self._set_status("Compression Done!")
+        self.time_label.setText("Compression Time(ms): " + str((time.perf_counter() - self.compression_start_time)*1000))
 
     def on_decompress_clicked(self):
         if self.current_bmp is None or self.original_grid is None:
             self._set_status("No BMP loaded.", error=True)
             return
-        if self.compressed_bits is None:
+        if self.compressed_data is None:
             self._set_status("Nothing to decompress (run compress first).", error=True)
             return
 
-        try:
-            self._set_status("Decompressing...", busy=True)
-            decoded = decompress_image(self.compressed_bits, self.width, self.height)
-
-            # Check if reconstruction matches
-            ok = self._compare_grids(self.original_grid, decoded)
-            if ok:
-                self._set_status("Decompression OK: image matches original.")
-                QMessageBox.information(self, "Decompression", "Decompression successful.\nImage matches original.")
-            else:
-                self._set_status("Decompression mismatch: pixels differ!!", error=True)
-                QMessageBox.warning(self, "Decompression", "Decompression finished, but image differs from original :(")
-        except Exception as e:
-            self._set_status(f"Decompression error: {e}", error=True)
+        self._set_status("Decompressing...", busy=True)
+        self._start_worker("Decompressing", self._on_decompressed, "Decompression error",
+                           decompress_image, self.compressed_data, self.width, self.height)
+
+    def _on_decompressed(self, decoded):
+        # Check if reconstruction matches
+        ok = self._compare_grids(self.original_grid, decoded)
+        if ok:
+            self._set_status("Decompression OK: image matches original.")
+            QMessageBox.information(self, "Decompression", "Decompression successful.\nImage matches original.")
+        else:
+            self._set_status("Decompression mismatch: pixels differ!!", error=True)
+            QMessageBox.warning(self, "Decompression", "Decompression finished, but image differs from original :(")
 
 
     def on_save_clicked(self):
-        if self.compressed_bits is None:
+        if self.compressed_data is None:
             QMessageBox.warning(self, "Save", "No compressed data, compress first")
             return
 
@@ -167,15 +199,12 @@ class CompressionWidget(QWidget):
             return
 
         try:
-            # Convert bitstream -> bytes
-            data_bytes = self._bits_to_bytes(self.compressed_bits)
-
             # Header: width & height (4 bytes each, little-endian)
             header = self.width.to_bytes(4, "little") + self.height.to_bytes(4, "little")
 
             with open(path, "wb") as f:
                 f.write(header)
-                f.write(data_bytes)
+                f.write(self.compressed_data)
 
             QMessageBox.information(self, "Saved", f"Compressed file saved:\n{path}")
             self._set_status("File saved successfully.")
@@ -185,6 +214,52 @@ class CompressionWidget(QWidget):
 
     # ================== Helpers ===============
 
+    def _start_worker(self, label, on_result, error_prefix, func, *args):
+        worker = CodecWorker(func, *args, parent=self)
+
+        def finish(handler, value):
+            # Ignore jobs that were superseded by a new BMP
+            if worker is not self._worker:
+                return
+            self._worker = None
+            self._set_busy(False)
+            handler(value)
+
+        worker.progress.connect(lambda done, total: self._queue_progress(f"{label}... tile {done}/{total}"))
+        worker.result.connect(lambda value: finish(on_result, value))
+        worker.failed.connect(lambda msg: finish(lambda m: self._set_status(f"{error_prefix}: {m}", error=True), msg))
+        worker.finished.connect(lambda: self._workers.discard(worker))
+        worker.finished.connect(worker.deleteLater)
+
+        self._worker = worker
+        self._workers.add(worker)
+        self._set_busy(True)
+        worker.start()
+
+    def _wait_for_workers(self):
+        # A QThread destroyed while it still runs aborts the whole process, so on quit let
+        # running jobs finish first
+        for worker in list(self._workers):
+            worker.wait()
+
+    def _set_busy(self, busy: bool):
+        self.compress_btn.setEnabled(not busy)
+        self.decompress_btn.setEnabled(not busy)
+        if busy:
+            self.save_btn.setEnabled(False)
+        else:
+            self.save_btn.setEnabled(self.compressed_data is not None)
+            self._progress_timer.stop()
+
+    def _queue_progress(self, text: str):
+        self._progress_text = text
+        if not self._progress_timer.isActive():
+            self._progress_timer.start()
+
+    def _show_progress(self):
+        if self._worker is not None:
+            self._set_status(self._progress_text, busy=True)
+
     def _set_status(self, text: str, error: bool = False, busy: bool = False):
         if error:
             self.status_label.setStyleSheet("color: red;")
@@ -196,30 +271,6 @@ class CompressionWidget(QWidget):
 
     @staticmethod
     def _compare_grids(a, b):
-        if len(a) != len(b):
-            return False
-        for row1, row2 in zip(a, b):
-            if len(row1) != len(row2):
-                return False
-            for p1, p2 in zip(row1, row2):
-                if p1 != p2:
-                    return False
-        return True
-    
-    @staticmethod
-    def _bits_to_bytes(bits):
-        out = bytearray()
-        byte = 0
-        count = 0
-        for b in bits:
-            byte = (byte << 1) | b
-            count += 1
-            if count == 8:
-                out.append(byte)
-                byte = 0
-                count = 0
-        if count > 0:
-            byte <<= (8 - count)
-            out.append(byte)
-        return bytes(out)
-
+        a = np.asarray(a)
+        b = np.asarray(b)
+        return a.shape == b.shape and np.array_equal(a, b)
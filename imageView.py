@@ -1,7 +1,58 @@
-import copy
+import itertools
 import math
-from PyQt5.QtWidgets import QLabel
-from PyQt5.QtGui import QImage, QPixmap, QColor
+from functools import lru_cache
+import numpy as np
+from PyQt5.QtCore import QThread, QTimer, pyqtSignal
+from PyQt5.QtWidgets import QApplication, QLabel
+from PyQt5.QtGui import QImage, QPixmap, QPixmapCache, QColor
+from jit import njit, prange, serialized, HAVE_NUMBA
+
+# OpenCV is optional. Without it bilinear_resize and gaussian_blur run in Python/NumPy
+try:
+    import cv2
+    HAVE_CV2 = True
+except ImportError:
+    HAVE_CV2 = False
+
+# BT.601 YUV, applied to RGB column vectors
+RGB_TO_YUV = np.array([[0.299, 0.587, 0.114],
+                       [-0.14713, -0.28886, 0.436],
+                       [0.615, -0.51499, -0.10001]])
+YUV_TO_RGB = np.array([[1.0, 0.0, 1.13983],
+                       [1.0, -0.39465, -0.58060],
+                       [1.0, 2.03211, 0.0]])
+
+# Finished frames go in QPixmapCache (KB). Enough for a handful of full size frames, so
+# flipping a slider or channel back to an earlier setting just shows the old pixmap
+PIXMAP_CACHE_KB = 64 * 1024
+# Every render_bmp gets a new id, part of the cache key of its frames
+_load_ids = itertools.count()
+
+
+class RebuildWorker(QThread):
+    # Runs ImageView's rebuild stages off the GUI thread
+    result = pyqtSignal(object) # (stage cache, finished (H, W, 3) grid)
+
+    def __init__(self, src, stages, cache, parent=None):
+        super().__init__(parent)
+        self.src = src
+        self.stages = stages
+        self.cache = cache
+
+    def run(self):
+        # Each stage's output is kept with the arguments it came from, its own and those of
+        # the stages before it. A slider change then only reruns the stages from the first
+        # one it affects, e.g. a new scale just resizes the cached masked + brightened image
+        src = self.src
+        key = ()
+        for i, (stage, args) in enumerate(self.stages):
+            key += (args,)
+            cached = self.cache[i]
+            if cached is None or cached[0] != key:
+                cached = self.cache[i] = (key, stage(src, *args))
+            src = cached[1]
+        # Signals are queued across threads, the view renders it on the GUI thread
+        self.result.emit((self.cache, src))
 
 
 class ImageView(QLabel):
@@ -17,129 +68,248 @@ class ImageView(QLabel):
         self.mask_g = True
         self.mask_b = True
         self.gamma = 1.0
+        # (settings key, output) of every rebuild stage, see RebuildWorker
+        self._stages = [None] * 3
+        # A setter asked for a rebuild that hasn't run yet, see _schedule_rebuild
+        self._rebuild_pending = False
+        # Running RebuildWorker, if any, and whether another rebuild waits for it
+        self._worker = None
+        self._rebuild_queued = False
+        self._load_id = next(_load_ids)
+        if QPixmapCache.cacheLimit() < PIXMAP_CACHE_KB:
+            QPixmapCache.setCacheLimit(PIXMAP_CACHE_KB)
 
         # backing image
         self.image = QImage(width, height, QImage.Format_RGB32)
         self.image.fill(QColor(0, 0, 0))
         self.setPixmap(QPixmap.fromImage(self.image))
 
+        QApplication.instance().aboutToQuit.connect(self._wait_for_rebuild)
+
 
     def render_bmp(self, bmp):
         #Load a new BMP, render once
         self.bmp = bmp
+        # Decode the pixels once per file, every rebuild after this reads bmp.pixelmap
+        if bmp is not None and bmp.pixelmap is None:
+            bmp.pixelmap = bmp.generatePixelGrid()
         # Reset pipeline for new image
         self.scale = 1.0
         self.mask_r = self.mask_g = self.mask_b = True
         self.gamma = 1.0
+        self._stages = [None] * 3
+        self._load_id = next(_load_ids)
         self.rebuild()
 
     def set_scale(self, factor: float):
         if not self.bmp:
             return
-        self.scale = max(0.01, float(factor))
-        self.rebuild()
+        factor = max(0.01, float(factor))
+        if factor == self.scale:
+            return
+        self.scale = factor
+        self._schedule_rebuild()
 
     def set_rgb_mask(self, red=True, green=True, blue=True):
         if not self.bmp:
             return
-        self.mask_r, self.mask_g, self.mask_b = bool(red), bool(green), bool(blue)
-        self.rebuild()
+        mask = (bool(red), bool(green), bool(blue))
+        if mask == (self.mask_r, self.mask_g, self.mask_b):
+            return
+        self.mask_r, self.mask_g, self.mask_b = mask
+        self._schedule_rebuild()
 
     def set_gamma(self, gamma_value: float):
         if not self.bmp:
             return
         # keep it sane
-        self.gamma = max(0.01, float(gamma_value))
-        self.rebuild()
+        gamma = max(0.01, float(gamma_value))
+        if gamma == self.gamma:
+            return
+        self.gamma = gamma
+        self._schedule_rebuild()
+
+    def _schedule_rebuild(self):
+        # Rebuild once control is back in the event loop, so setters called one after
+        # another (e.g. several sliders settling together) share a single rebuild
+        if not self._rebuild_pending:
+            self._rebuild_pending = True
+            QTimer.singleShot(0, self._run_pending_rebuild)
+
+    def _run_pending_rebuild(self):
+        # Nothing to do if a direct rebuild (e.g. render_bmp) already ran since
+        if self._rebuild_pending:
+            self.rebuild()
 
 
     def rebuild(self):
+        self._rebuild_pending = False
         if not self.bmp:
             return
+        if self._worker is not None:
+            # One rebuild at a time. The next one starts with the latest settings once the
+            # running one is done, see _rebuild_done
+            self._rebuild_queued = True
+            return
+        self._rebuild_queued = False
+
+        # Every stage below makes a new array, so the pixelmap itself is never written to and
+        # doesn't need copying (asarray is a no-op for BMPFile's (H, W, 3) uint8 grid)
+        src = np.asarray(self.bmp.pixelmap, dtype=np.uint8)
+
+        # Shown with these exact settings before (and still cached)
+        mask = (self.mask_r, self.mask_g, self.mask_b)
+        key = f"ImageView/{self._load_id}/{self.scale!r}/{self.gamma!r}/{mask}"
+        pixmap = QPixmapCache.find(key)
+        if pixmap is not None:
+            self.setMinimumSize(pixmap.width(), pixmap.height())
+            self.setPixmap(pixmap)
+            return
+
+        # Default settings, where every image starts: all stages would hand src straight
+        # through, so show it right here instead of going through a worker. Cached like
+        # any other frame, so going back to the defaults doesn't pack the pixelmap again
+        src_h, src_w = src.shape[:2]
+        if (all(mask) and abs(self.gamma - 1.0) <= 1e-6
+                and max(1, int(src_w * self.scale)) == src_w
+                and max(1, int(src_h * self.scale)) == src_h
+                and not (self.bmp.bpp == 1 and self.scale < 1.0)):
+            self._render_from_pixelgrid(src)
+            QPixmapCache.insert(key, self.pixmap())
+            return
 
-        src = copy.deepcopy(self.bmp.pixelmap if self.bmp.pixelmap else self.bmp.generatePixelGrid())
+        # Stages get the settings as arguments, so slider changes while the worker runs
+        # don't reach it. The arguments are also what a cached stage output is checked against
+        binary = self.bmp.bpp == 1 and self.bmp.numColors <= 2
+        stages = (
+            (self._apply_blur, (self.bmp.bpp == 1 and self.scale < 1.0,)),
+            (self._apply_color, (mask, self.gamma, binary)),
+            (self._apply_scale, (self.scale,)),
+        )
+        # The worker fills a copy of the cache, taken over only if its result is used
+        bmp = self.bmp
+        worker = RebuildWorker(src, stages, list(self._stages), parent=self)
+        worker.result.connect(lambda value: self._show_rebuild(bmp, key, value))
+        worker.finished.connect(self._rebuild_done)
+        worker.finished.connect(worker.deleteLater)
+
+        self._worker = worker
+        worker.start()
+
+    def _show_rebuild(self, bmp, key, value):
+        # Ignore rebuilds of an image that was replaced since (render_bmp's own rebuild
+        # is queued behind this one)
+        if bmp is not self.bmp:
+            return
+        self._stages, out = value
 
+        # 4) Render the image
+        self._render_from_pixelgrid(out)
+        QPixmapCache.insert(key, self.pixmap())
+
+    def _rebuild_done(self):
+        self._worker = None
+        if self._rebuild_queued:
+            self.rebuild()
+
+    def _wait_for_rebuild(self):
+        # A RebuildWorker destroyed with the view while it still runs aborts the process.
+        # On quit let it finish, and don't start the queued one
+        self._rebuild_queued = False
+        if self._worker is not None:
+            self._worker.wait()
+
+    @staticmethod
+    def _apply_blur(src, blur):
         # Idk if this allowed, but its we do a low pass on the image with a gaussian kernel
-        # to reduce dithering artifacts
-        if self.bmp.bpp == 1 and self.scale < 1.0:
+        # to reduce dithering artifacts (1bpp images when shrinking)
+        if blur:
             src = gaussian_blur(src, radius=1, sigma=0.8)
+        return src
 
-        # 1) RGB channel toggles
-        if not (self.mask_r and self.mask_g and self.mask_b):
-            h, w = len(src), len(src[0])
-            for y in range(h):
-                row = src[y]
-                for x in range(w):
-                    r, g, b = row[x]
-                    row[x] = (
-                        r if self.mask_r else 0,
-                        g if self.mask_g else 0,
-                        b if self.mask_b else 0
-                    )
+    @staticmethod
+    def _apply_color(src, mask, gamma, binary):
+        # 1) RGB channel toggles and 2) brightness, in one pass over the image
+        masked = not all(mask)
 
         # 2) Accidently implemented gamma instead of YUV based brightness. Changed it last moent
-        if abs(self.gamma - 1.0) > 1e-6:
-            # Normalize gamma value (last moment change)
-            brightness_scale = self.gamma / 1.5
-
-            h, w = len(src), len(src[0])
-            for y in range(h):
-                row = src[y]
-                for x in range(w):
-                    r, g, b = row[x]
-                    if self.bmp.numColors > 2 or self.bmp.bpp != 1:
-                        Y = 0.299 * r + 0.587 * g + 0.114 * b
-                        U = -0.14713 * r - 0.28886 * g + 0.436 * b
-                        V = 0.615 * r - 0.51499 * g - 0.10001 * b
-
-                        # Scale Y by normalized brightness
-                        Y *= brightness_scale
-
-                        # Convert back to RGB
-                        r = int(Y + 1.13983 * V)
-                        g = int(Y - 0.39465 * U - 0.58060 * V)
-                        b = int(Y + 2.03211 * U)
-
-                    else:
-                        # For binary (1bpp) images, approximate brightness bump
-                        factor = (brightness_scale - 1.0) * 127
-                        r = int(r + factor)
-                        g = int(g + factor)
-                        b = int(b + factor)
-
-                    # Clamp
-                    r = max(0, min(255, r))
-                    g = max(0, min(255, g))
-                    b = max(0, min(255, b))
-                    row[x] = (r, g, b)
+        if abs(gamma - 1.0) <= 1e-6:
+            if masked:
+                src = src * np.array(mask, dtype=np.uint8)
+            return src
+
+        # Normalize gamma value (last moment change)
+        brightness_scale = gamma / 1.5
+
+        if not binary:
+            # RGB -> YUV, scale Y by normalized brightness, back to RGB: all one 3x3 matrix.
+            # Masking the input first is the same as zeroing those columns of the matrix
+            m = YUV_TO_RGB @ np.diag([brightness_scale, 1.0, 1.0]) @ RGB_TO_YUV
+            if masked:
+                m = m @ np.diag(np.array(mask, dtype=np.float64))
+            offset = 0
+        else:
+            # For binary (1bpp) images, approximate brightness bump.
+            # int(r + factor) on an integer r is r + floor(factor) wherever the clamp keeps it
+            offset = math.floor((brightness_scale - 1.0) * 127)
+            if HAVE_CV2:
+                # Saturating uint8 add in SIMD, clamps both ways. (Not convertScaleAbs, it
+                # rounds instead of flooring and its abs() would flip pixels pushed below 0)
+                if masked:
+                    src = src * np.array(mask, dtype=np.uint8)
+                return cv2.add(np.ascontiguousarray(src), (offset, offset, offset, 0))
+            # Masked channels only get the offset
+            m = np.diag(np.array(mask, dtype=np.float64))
+
+        if HAVE_NUMBA:
+            # lut[k, v, c] is what input channel k at value v adds to output channel c, so
+            # every output value is 3 table lookups (float64, exact for the 1bpp offsets).
+            # C order, the layout the kernel is warmed up with below
+            lut = np.ascontiguousarray(m.T[:, None, :] * np.arange(256.0)[None, :, None])
+            lut[0] += offset
+            return _color_lut_jit(np.ascontiguousarray(src), lut)
+
+        if binary:
+            out = src.astype(np.int16)
+            if masked:
+                out *= np.array(mask, dtype=np.int16)
+            out += offset
+        else:
+            out = src.astype(np.float32) @ m.T.astype(np.float32)
+
+        # Clamp, the uint8 cast then truncates like int() did
+        return np.clip(out, 0, 255, out=out).astype(np.uint8)
 
+    @staticmethod
+    def _apply_scale(src, scale):
         # 3) Scale. If factor around 1, keep as-is
-        if self.scale <= 0:
-            self.scale = 0.01
+        if scale <= 0:
+            scale = 0.01
         src_h, src_w = len(src), len(src[0])
-        new_w = max(1, int(src_w * self.scale))
-        new_h = max(1, int(src_h * self.scale))
+        new_w = max(1, int(src_w * scale))
+        new_h = max(1, int(src_h * scale))
 
         if new_w != src_w or new_h != src_h:
-            out = bilinear_resize(src, new_w, new_h, src_w, src_h, self.scale)
-        else:
-            out = src
-
-        # 4) Render the image
-        self._render_from_pixelgrid(out)
+            # Scale derived from the final size, like cv2.resize does, so the output always
+            # spans the whole source (and tiny sizes don't sample past the edge)
+            return bilinear_resize(src, new_w, new_h, src_w, src_h)
+        return src
 
 
     def _render_from_pixelgrid(self, grid):
-        h = len(grid)
-        w = len(grid[0])
+        # Write the whole (H, W, 3) grid straight into the QImage's own pixel buffer
+        arr = np.asarray(grid, dtype=np.uint8)
+        h, w = arr.shape[:2]
         self.setMinimumSize(w, h)
-        self.image = QImage(w, h, QImage.Format_RGB32)
 
-        for y in range(h):
-            row = grid[y]
-            for x in range(w):
-                r, g, b = row[x]
-                self.image.setPixel(x, y, QColor(r, g, b).rgb())
+        self.image = QImage(w, h, QImage.Format_RGB32)
+        ptr = self.image.bits()
+        ptr.setsize(h * self.image.bytesPerLine())
+        # Each 0xffRRGGBB word is the bytes B, G, R, 0xff in memory (little endian)
+        buf = np.frombuffer(ptr, dtype=np.uint8).reshape(h, self.image.bytesPerLine())
+        buf = buf[:, :4 * w].reshape(h, w, 4)
+        buf[..., :3] = arr[..., ::-1]
+        buf[..., 3] = 0xFF
 
         self.setPixmap(QPixmap.fromImage(self.image))
 
@@ -150,9 +320,13 @@ class ImageView(QLabel):
 # has issues with dithering from the 1bpp images tho. If i had more time maybe I could do a low pass filter
 # Rescales bmp.pixelgrid into self.pixelgrid
 def bilinear_resize(src, new_w, new_h, src_w=None, src_h=None, scale=None):
+    if HAVE_CV2:
+        # Same pixel-centre mapping, as OpenCV's SIMD kernel (on a (H, W, 3) uint8 array)
+        return cv2.resize(np.ascontiguousarray(src, dtype=np.uint8), (new_w, new_h),
+                          interpolation=cv2.INTER_LINEAR)
+
     if src_h is None: src_h = len(src)
     if src_w is None: src_w = len(src[0])
-    out = [[(0, 0, 0) for _ in range(new_w)] for _ in range(new_h)]
 
     # map output pixel centers back to source
     # derive scale if not provided
@@ -162,68 +336,128 @@ def bilinear_resize(src, new_w, new_h, src_w=None, src_h=None, scale=None):
     else:
         scale_x = scale_y = scale
 
-    for y_out in range(new_h):
-        src_y = (y_out + 0.5) / scale_y - 0.5
+    if HAVE_NUMBA:
+        return _bilinear_resize_jit(np.ascontiguousarray(src, dtype=np.uint8), new_w, new_h,
+                                    float(scale_x), float(scale_y))
+
+    # Sample positions and weights only depend on the sizes, so each axis comes from a
+    # lookup table and the resize is 4 gathers and a weighted sum over the whole image
+    x0, x1, wx = _bilinear_axis(src_w, new_w, float(scale_x))
+    y0, y1, wy = _bilinear_axis(src_h, new_h, float(scale_y))
+    src = np.asarray(src, dtype=np.uint8)
+    y0 = y0[:, None]; y1 = y1[:, None]
+
+    # Same products in the same order as per pixel, (1 - wx) * (1 - wy) * c00 + ...
+    w00 = ((1 - wx)[None, :] * (1 - wy)[:, None])[..., None]
+    w10 = (wx[None, :] * (1 - wy)[:, None])[..., None]
+    w01 = ((1 - wx)[None, :] * wy[:, None])[..., None]
+    w11 = (wx[None, :] * wy[:, None])[..., None]
+    out = (w00 * src[y0, x0] + w10 * src[y0, x1] +
+           w01 * src[y1, x0] + w11 * src[y1, x1])
+    # int() truncation, values are never negative
+    return out.astype(np.uint8)
+
+
+@lru_cache(maxsize=32)
+def _bilinear_axis(src_len, new_len, scale):
+    # For every output column (or row): the two source ones around its centre and the
+    # weight of the second. Read-only, shared between calls with the same sizes
+    pos = (np.arange(new_len) + 0.5) / scale - 0.5
+    i0 = pos.astype(np.intp)
+    i1 = np.clip(i0 + 1, 0, src_len - 1)
+    w = pos - i0
+    i0 = np.maximum(i0, 0)
+    for arr in (i0, i1, w):
+        arr.setflags(write=False)
+    return i0, i1, w
+
+
+@serialized
+@njit(parallel=True, fastmath=True, cache=True, boundscheck=False, nogil=True)
+def _bilinear_resize_jit(src, new_w, new_h, scale_x, scale_y):
+    # bilinear_resize's loop on a (H, W, 3) uint8 array. Output rows don't depend on
+    # each other, so they're split across threads
+    src_h, src_w = src.shape[:2]
+    inv_x = 1.0 / scale_x
+    inv_y = 1.0 / scale_y
+    out = np.empty((new_h, new_w, 3), dtype=np.uint8)
+
+    for y_out in prange(new_h):
+        src_y = (y_out + 0.5) * inv_y - 0.5
         y0 = int(src_y)
         y1 = min(max(y0 + 1, 0), src_h - 1)
         wy = src_y - y0
         if y0 < 0: y0 = 0
 
         for x_out in range(new_w):
-            src_x = (x_out + 0.5) / scale_x - 0.5
+            src_x = (x_out + 0.5) * inv_x - 0.5
             x0 = int(src_x)
             x1 = min(max(x0 + 1, 0), src_w - 1)
             wx = src_x - x0
             if x0 < 0: x0 = 0
 
-            c00 = src[y0][x0]
-            c10 = src[y0][x1]
-            c01 = src[y1][x0]
-            c11 = src[y1][x1]
+            for c in range(3):
+                v = ((1 - wx) * (1 - wy) * src[y0, x0, c] + wx * (1 - wy) * src[y0, x1, c] +
+                     (1 - wx) * wy * src[y1, x0, c] + wx * wy * src[y1, x1, c])
+                out[y_out, x_out, c] = int(v)
+    return out
+
 
-            r = int((1 - wx) * (1 - wy) * c00[0] + wx * (1 - wy) * c10[0] +
-                    (1 - wx) * wy * c01[0] + wx * wy * c11[0])
-            g = int((1 - wx) * (1 - wy) * c00[1] + wx * (1 - wy) * c10[1] +
-                    (1 - wx) * wy * c01[1] + wx * wy * c11[1])
-            b = int((1 - wx) * (1 - wy) * c00[2] + wx * (1 - wy) * c10[2] +
-                    (1 - wx) * wy * c01[2] + wx * wy * c11[2])
+if HAVE_NUMBA and not HAVE_CV2:
+    # Compile (or load from the cache) now instead of on the first scale change
+    _bilinear_resize_jit(np.zeros((2, 2, 3), dtype=np.uint8), 1, 1, 0.5, 0.5)
 
-            out[y_out][x_out] = (r, g, b)
+
+@serialized
+@njit(parallel=True, cache=True, boundscheck=False, nogil=True)
+def _color_lut_jit(src, lut):
+    # ImageView._apply_color's matrix (and offset) on a (H, W, 3) uint8 array through the
+    # per channel tables in lut, clamped and truncated like the NumPy path. No fastmath,
+    # the sums stay in the same order as the float64 matrix product
+    h, w = src.shape[:2]
+    out = np.empty((h, w, 3), dtype=np.uint8)
+    for y in prange(h):
+        for x in range(w):
+            r = src[y, x, 0]
+            g = src[y, x, 1]
+            b = src[y, x, 2]
+            for c in range(3):
+                v = lut[0, r, c] + lut[1, g, c] + lut[2, b, c]
+                out[y, x, c] = np.uint8(min(max(v, 0.0), 255.0))
     return out
 
 
-def gaussian_kernel(radius=1, sigma=1.0):
-    size = 2 * radius + 1
-    kernel = [[0.0 for _ in range(size)] for _ in range(size)]
-    sum_val = 0.0
-    for y in range(-radius, radius + 1):
-        for x in range(-radius, radius + 1):
-            val = math.exp(-(x * x + y * y) / (2.0 * sigma * sigma))
-            kernel[y + radius][x + radius] = val
-            sum_val += val
-    for j in range(size):
-        for i in range(size):
-            kernel[j][i] /= sum_val
+if HAVE_NUMBA:
+    # Same for the first brightness change
+    _color_lut_jit(np.zeros((1, 1, 3), dtype=np.uint8), np.zeros((3, 256, 3)))
+
+
+@lru_cache(maxsize=32)
+def gaussian_kernel_1d(radius=1, sigma=1.0):
+    # Always called with the same few (radius, sigma), so the kernel is built once per pair.
+    # Read-only, every caller shares the cached array
+    x = np.arange(-radius, radius + 1)
+    kernel = np.exp(-(x * x) / (2.0 * sigma * sigma))
+    kernel /= kernel.sum()
+    kernel.setflags(write=False)
     return kernel
 
 
 def gaussian_blur(pixelgrid, radius=1, sigma=1.0):
-    kernel = gaussian_kernel(radius, sigma)
-    size = len(kernel)
-    h = len(pixelgrid)
-    w = len(pixelgrid[0])
-    out = [[(0, 0, 0) for _ in range(w)] for _ in range(h)]
-    for y in range(h):
-        for x in range(w):
-            r_acc = g_acc = b_acc = 0.0
-            for j in range(size):
-                for i in range(size):
-                    yy = min(max(y + j - radius, 0), h - 1)
-                    xx = min(max(x + i - radius, 0), w - 1)
-                    kr = kernel[j][i]
-                    r, g, b = pixelgrid[yy][xx]
-                    r_acc += r * kr
-                    g_acc += g * kr
-                    b_acc += b * kr
-            out[y][x] = (int(r_acc + 0.5), int(g_acc + 0.5), int(b_acc + 0.5))
-    return out
+    # A 2D Gaussian is the outer product of two 1D ones, so blur the rows, then the
+    # columns: 2K taps per pixel instead of K^2. Edge pixels repeat past the border
+    if HAVE_CV2:
+        # OpenCV does the same two passes in SIMD
+        size = 2 * radius + 1
+        return cv2.GaussianBlur(np.ascontiguousarray(pixelgrid, dtype=np.uint8), (size, size), sigma,
+                                borderType=cv2.BORDER_REPLICATE)
+
+    kernel = gaussian_kernel_1d(radius, sigma)
+    src = np.asarray(pixelgrid, dtype=np.float64)
+    h, w = src.shape[:2]
+
+    padded = np.pad(src, ((0, 0), (radius, radius), (0, 0)), mode="edge")
+    rows = sum(k * padded[:, i:i + w] for i, k in enumerate(kernel))
+    padded = np.pad(rows, ((radius, radius), (0, 0), (0, 0)), mode="edge")
+    out = sum(k * padded[j:j + h] for j, k in enumerate(kernel))
+    return np.floor(out + 0.5).astype(np.uint8)
@@ -0,0 +1,31 @@
+import functools
+import threading
+
+# Numba is optional. Without it the @njit kernels still run as plain Python, just slower
+try:
+    from numba import njit, prange
+    HAVE_NUMBA = True
+except ImportError:
+    HAVE_NUMBA = False
+    prange = range
+
+    def njit(*args, **kwargs):
+        # Supports both @njit and @njit(...)
+        if len(args) == 1 and callable(args[0]) and not kwargs:
+            return args[0]
+        return lambda func: func
+
+
+# Without TBB or OpenMP numba falls back to its workqueue threading layer, which aborts the
+# process if two threads run parallel=True kernels at once (e.g. a BMP parsing on the load
+# thread while the view resizes). Those kernels are wrapped in this, each one already uses
+# every core so queueing them costs nothing
+_parallel_lock = threading.Lock()
+
+
+def serialized(kernel):
+    @functools.wraps(kernel)
+    def call(*args):
+        with _parallel_lock:
+            return kernel(*args)
+    return call
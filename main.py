@@ -4,12 +4,17 @@ from PyQt5.QtWidgets import (
     QApplication, QPushButton, QMainWindow, QWidget,
     QVBoxLayout, QLabel, QHBoxLayout
 )
+import os
+import struct
 import sys
+import numpy as np
 
 from bmpfile import BMPFile
+from compress import compress_image, decompress_image
+from jit import HAVE_NUMBA
 from debouncedSlider import DebouncedSlider
 from imageView import ImageView
-from compress_ui import CompressionWidget
+from compress_ui import CodecWorker, CompressionWidget
 
 app = QApplication(sys.argv)
 
@@ -29,7 +34,7 @@ class FileDrop(QWidget):
         self.setMinimumSize(400, 280)
         layout.addWidget(self.label)
 
-        # Default style
+        # Default and hover style in one sheet, setHoverStyle just flips the hover property
         self.setStyleSheet("""
             QWidget {
                 background-color: #f9f9f9;
@@ -41,6 +46,14 @@ class FileDrop(QWidget):
                 color: #555;
                 padding: 40px;
             }
+            QWidget[hover="true"] {
+                background-color: #e3f2fd;
+                border: 3px solid #42a5f5;
+                box-shadow: 0px 0px 15px rgba(66, 165, 245, 0.4);
+            }
+            QLabel[hover="true"] {
+                color: #1e88e5;
+            }
         """)
 
         self.setMinimumSize(300, 200)
@@ -83,37 +96,53 @@ class FileDrop(QWidget):
             event.ignore()
 
     def setHoverStyle(self, hovering: bool):
+        # The label is styled by the QWidget rules too, so it gets the property as well.
+        # Re-polishing only re-matches the already parsed sheet
+        for widget in (self, self.label):
+            widget.setProperty("hover", hovering)
+            widget.style().unpolish(widget)
+            widget.style().polish(widget)
         if hovering:
-            self.setStyleSheet("""
-                QWidget {
-                    background-color: #e3f2fd;
-                    border: 3px solid #42a5f5;
-                    border-radius: 20px;
-                    box-shadow: 0px 0px 15px rgba(66, 165, 245, 0.4);
-                    transition: all 0.25s ease;
-                }
-                QLabel {
-                    color: #1e88e5;
-                    padding: 40px;
-                }
-            """)
             self.label.setText("Drop your BMP or .cmpt365 file!")
         else:
-            self.setStyleSheet("""
-                QWidget {
-                    background-color: #f9f9f9;
-                    border: 3px dashed #aaa;
-                    border-radius: 20px;
-                    transition: all 0.25s ease;
-                }
-                QLabel {
-                    color: #555;
-                    padding: 40px;
-                }
-            """)
             self.label.setText("Drop BMP or .cmpt365 file here")
 
 
+def load_bmp(path, progress=None):
+    # Runs on a CodecWorker: read the BMP and parse its pixels
+    bmp = BMPFile(path)
+    bmp.generatePixelGrid()
+    # The pixelmap is a copy, so the file doesn't have to stay mapped while it's shown
+    bmp.close()
+    return bmp
+
+
+def load_compressed(path, progress=None):
+    # Runs on a CodecWorker: read a .cmpt365 file and decode it into a stand-in BMPFile
+    with open(path, "rb") as f:
+        raw = f.read()
+
+    # First 8 bytes: width, height
+    width, height = struct.unpack_from("<II", raw, 0)
+
+    # Remaining data is the packed bitstream. A view, decompress_image only reads
+    # slices of it, so the payload isn't copied
+    data = memoryview(raw)[8:]
+
+    # Decompress
+    grid = decompress_image(data, width, height, progress=progress)
+
+    # Mock BMPFile to show decoded pixels (just wanna reuse code)
+    bmp = BMPFile(None)
+    bmp.filename = os.path.basename(path)
+    bmp.fileSize = len(raw)
+    bmp.width = width
+    bmp.height = height
+    bmp.bpp = 24
+    bmp.pixelmap = grid
+    return bmp
+
+
 class MainWindow(QMainWindow):
     def __init__(self):
         super().__init__()
@@ -201,6 +230,9 @@ class MainWindow(QMainWindow):
         self.mainwidget.setLayout(layout)
         self.setCentralWidget(self.mainwidget)
 
+        self._load_worker = None # CodecWorker loading the last dropped file, if any
+        self._load_workers = set() # every load that hasn't finished, superseded ones too
+
     def _readableFileSizeScale(self, size):
         if size < 1000: return f"{size} bytes"
         if size < 1_000_000: return f"{size/1000:.2f} KB"
@@ -217,14 +249,51 @@ class MainWindow(QMainWindow):
     def onBMPOpen(self, data):
         ftype, path = data
 
+        # Read and decode on a worker thread, the window stays usable meanwhile
         if ftype == "bmp":
-            bmp = BMPFile(path)
-            self.showFileMetadata(bmp.filename, bmp.fileSize, bmp.width, bmp.height, bmp.bpp)
-            self.ImageViewer.render_bmp(bmp)
-            self.compression_widget.set_bmp(bmp)
-
+            self._start_load(path, load_bmp, self.showBMP)
         elif ftype == "compress":
-            self.openCompressedFile(path)
+            self._start_load(path, load_compressed, self.showCompressedFile)
+
+    def _start_load(self, path, func, on_loaded):
+        worker = CodecWorker(func, path, parent=self)
+        name = os.path.basename(path)
+
+        def finish(handler, value):
+            # Ignore loads superseded by a newer drop
+            if worker is not self._load_worker:
+                return
+            self._load_worker = None
+            handler(value)
+
+        def progress(done, total):
+            if worker is self._load_worker:
+                self.filename_label.setText(f"Loading {name}... tile {done}/{total}")
+
+        # Unsupported or malformed file, keep whatever is currently shown
+        failed = lambda msg: self.filename_label.setText(f"Can't open {path}: {msg}")
+        worker.progress.connect(progress)
+        worker.result.connect(lambda bmp: finish(on_loaded, bmp))
+        worker.failed.connect(lambda msg: finish(failed, msg))
+        worker.finished.connect(lambda: self._load_workers.discard(worker))
+        worker.finished.connect(worker.deleteLater)
+
+        self._load_worker = worker
+        self._load_workers.add(worker)
+        self.filename_label.setText(f"Loading {name}...")
+        worker.start()
+
+    def closeEvent(self, event):
+        # A load still running would be destroyed with the window and abort the process,
+        # let it finish first
+        for worker in list(self._load_workers):
+            worker.wait()
+        super().closeEvent(event)
+
+    def showBMP(self, bmp):
+        self.showFileMetadata(bmp.filename, bmp.fileSize, bmp.width, bmp.height, bmp.bpp)
+        self.ImageViewer.render_bmp(bmp)
+        self.compression_widget.set_bmp(bmp)
 
 
     def apply_scale(self, slider_val):
@@ -244,46 +313,24 @@ class MainWindow(QMainWindow):
             blue=self.blue_btn.isChecked()
         )
 
-    def openCompressedFile(self, path):
-        with open(path, "rb") as f:
-            raw = f.read()
-
-        # First 8 bytes: width, height
-        width = int.from_bytes(raw[0:4], "little")
-        height = int.from_bytes(raw[4:8], "little")
-
-        # Remaining data is bits
-        data = raw[8:]
-        bitstream = []
-        for byte in data:
-            for i in range(8):
-                bitstream.append((byte >> (7 - i)) & 1)
-
-        # Decompress
-        from compress import decompress_image
-        grid = decompress_image(bitstream, width, height)
-
-        # Mock BMPFile to show decoded pixels (just wanna reuse code)
-        bmp = BMPFile(None)
-        bmp.filename = path.split("/")[-1]
-        bmp.fileSize = len(raw)
-        bmp.width = width
-        bmp.height = height
-        bmp.bpp = 24
-        bmp.pixelmap = grid
-
+    def showCompressedFile(self, bmp):
         self.ImageViewer.render_bmp(bmp)
 
         # No metadata (since no true BMP header), show basic info
         self.filename_label.setText("Filename: " + bmp.filename)
-        self.size_label.setText(f"Size: {len(raw)} bytes")
-        self.dimensions_label.setText(f"Dimensions: {width}x{height}")
+        self.size_label.setText(f"Size: {bmp.fileSize} bytes")
+        self.dimensions_label.setText(f"Dimensions: {bmp.width}x{bmp.height}")
         self.bpp_label.setText("Bits per pixel: 24 (decoded)")
 
         self.compression_widget.set_bmp(bmp)
 
 
 if __name__ == '__main__':
+    if HAVE_NUMBA:
+        # Load the codec kernels (from numba's cache, or compile them) now instead of on the
+        # first Compress click or .cmpt365 drop
+        decompress_image(compress_image(np.zeros((1, 1, 3), dtype=np.uint8)), 1, 1)
+
     window = MainWindow()
     window.show()
     app.exec()